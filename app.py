@@ -1,53 +1,120 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, g, Response, stream_with_context
 from flask_cors import CORS
+import atexit
+import click
+import hashlib
+import hmac
 import json
+import os
+from functools import wraps
 from datetime import datetime, timedelta
-from database import Database, Service, Review, Booking, Order
+from database import Database, SQLProfiler, ShardRouter, IdempotencyStore, ServiceCatalog, BackupScheduler, PopularityEngine, Order
+from events import EventBroker
+
+class BranchPathMiddleware:
+    """Вырезает префикс /branches/<branch> из пути и сохраняет филиал в environ"""
+    PREFIX = '/branches/'
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(self.PREFIX):
+            branch, _, rest = path[len(self.PREFIX):].partition('/')
+            environ['salon.branch'] = branch
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + self.PREFIX + branch
+            environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
 
 app = Flask(__name__)
 CORS(app)
-db = Database()
+app.wsgi_app = BranchPathMiddleware(app.wsgi_app)
+
+# Общий каталог и шарды филиалов (SALON_BRANCHES=center,north,...).
+# При шардировании в общей базе только каталог, а записи, сделанные до включения
+# шардирования, переносятся в филиал по умолчанию (SALON_DEFAULT_BRANCH, иначе первый в списке)
+branches = [b.strip() for b in os.environ.get('SALON_BRANCHES', '').split(',') if b.strip()]
+db = Database(branch=not branches)
+router = ShardRouter(
+    db,
+    branches=branches,
+    shard_path=os.environ.get('SALON_SHARD_PATH', 'grooming_salon_{branch}.db'),
+    default_branch=os.environ.get('SALON_DEFAULT_BRANCH')
+)
+
+# Каталог услуг в памяти процесса
+catalog = ServiceCatalog(db)
+
+# Популярность услуг по истории записей, рейтинг сворачивается в каталог в фоне
+popularity = PopularityEngine(
+    db,
+    half_life_days=float(os.environ.get('SALON_POPULARITY_HALF_LIFE_DAYS', 30)),
+    top_n=int(os.environ.get('SALON_POPULARITY_TOP_N', 3)),
+    min_history=float(os.environ.get('SALON_POPULARITY_MIN_HISTORY', 20))
+)
+popularity.start(interval=int(os.environ.get('SALON_POPULARITY_FOLD_INTERVAL', 300)))
+# Приращения, не дождавшиеся свертки, сохраняются при завершении процесса
+atexit.register(popularity.fold)
+
+# Ключи идемпотентности для POST-запросов, по одному хранилищу на филиал
+idempotency = {branch: IdempotencyStore(database) for branch, database in router.shards.items()}
+for store in idempotency.values():
+    store.start_evictor()
+
+# Резервное копирование: общий каталог и все филиалы (SALON_BACKUP_INTERVAL в секундах)
+backups = BackupScheduler(
+    [db] + [database for database in router.shards.values() if database is not db],
+    backup_dir=os.environ.get('SALON_BACKUP_DIR', 'backups'),
+    interval=int(os.environ.get('SALON_BACKUP_INTERVAL', 3600)),
+    keep=int(os.environ.get('SALON_BACKUP_KEEP', 7))
+)
+if os.environ.get('SALON_BACKUP_INTERVAL'):
+    backups.start()
+
+# Лента изменений для админки (SSE). Журнал событий ведется в базе филиала:
+# запись в общий каталог снова поставила бы все филиалы в очередь за одной блокировкой
+events = {branch: EventBroker(database) for branch, database in router.shards.items()}
+
+# Сохранение отчета профилировщика при завершении процесса
+if db.profiler and os.environ.get('SQL_PROFILE_DUMP'):
+    atexit.register(db.profiler.dump, os.environ['SQL_PROFILE_DUMP'])
 
 # Вспомогательные функции
-def row_to_service(row):
-    return Service(
-        id=row[0],
-        name=row[1],
-        description=row[2],
-        price=row[3],
-        category=row[4],
-        duration=row[5],
-        popular=bool(row[6])
-    ).to_dict()
+# Проекции полей для списков: поле ответа -> колонка таблицы.
+# Списки по умолчанию отдают краткую форму без тяжелых колонок
+BLOG_FIELDS = ('id', 'title', 'excerpt', 'content', 'category', 'author', 'read_time', 'image_url', 'views', 'created_at')
+BLOG_SUMMARY = ('id', 'title', 'excerpt', 'category', 'author', 'read_time', 'image_url', 'views', 'created_at')
 
-def row_to_review(row):
-    return Review(
-        id=row[0],
-        author_name=row[1],
-        author_avatar=row[2],
-        rating=row[3],
-        review_text=row[4],
-        service_name=row[5],
-        pet_type=row[6],
-        approved=bool(row[7]),
-        created_at=row[8]
-    ).to_dict()
+REVIEW_FIELDS = ('id', 'author_name', 'author_avatar', 'rating', 'review_text', 'service_name', 'pet_type', 'approved', 'created_at')
+REVIEW_SUMMARY = ('id', 'author_name', 'author_avatar', 'rating', 'review_text', 'service_name', 'pet_type', 'created_at')
 
-def row_to_booking(row):
-    return Booking(
-        id=row[0],
-        customer_name=row[1],
-        customer_phone=row[2],
-        pet_name=row[5],
-        pet_breed=row[6],
-        service_name=row[7],
-        service_price=row[8],
-        booking_date=row[9],
-        booking_time=row[10],
-        status=row[11],
-        notes=row[12],
-        created_at=row[13]
-    ).to_dict()
+BOOKING_FIELDS = ('id', 'customer_name', 'customer_phone', 'customer_email', 'pet_name', 'pet_breed', 'service_name',
+                  'service_price', 'booking_date', 'booking_time', 'status', 'notes', 'created_at')
+BOOKING_SUMMARY = ('id', 'customer_name', 'customer_phone', 'pet_name', 'service_name', 'service_price',
+                   'booking_date', 'booking_time', 'status')
+
+BOOLEAN_FIELDS = {'approved', 'featured', 'popular'}
+
+def requested_fields(allowed, default):
+    """Поля из параметра fields= (через запятую, all - все поля)"""
+    raw = request.args.get('fields')
+    if not raw:
+        return default
+    if raw == 'all':
+        return allowed
+    
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields or default
+
+def project_row(fields, row):
+    return {
+        field: bool(value) if field in BOOLEAN_FIELDS else value
+        for field, value in zip(fields, row)
+    }
 
 def row_to_order(row):
     return Order(
@@ -60,33 +127,106 @@ def row_to_order(row):
         created_at=row[6]
     ).to_dict()
 
+def branch_db():
+    """База филиала текущего запроса"""
+    return router.get(g.branch)
+
+@app.before_request
+def resolve_branch():
+    # Филиал берется из пути, заголовка X-Branch или поддомена
+    branch = request.environ.get('salon.branch') or request.headers.get('X-Branch')
+    if not branch and router.sharded:
+        subdomain = request.host.split(':')[0].split('.')[0]
+        if subdomain in router:
+            branch = subdomain
+    
+    if branch and branch not in router:
+        return jsonify({'success': False, 'error': f'Unknown branch: {branch}'}), 404
+    
+    g.branch = branch or router.default_branch
+
+def after_commit(func):
+    """Побочные действия после фиксации записи: ошибка пишется в лог и не превращает
+    уже выполненную запись в ответ 500 (иначе повтор с Idempotency-Key создал бы дубль)"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            app.logger.exception('%s failed after commit', func.__name__)
+    
+    return wrapper
+
+@after_commit
+def publish_event(event_type, data):
+    """Публикация изменения в ленту /api/events от имени филиала запроса"""
+    if router.sharded:
+        data = dict(data, branch=g.branch)
+    events[g.branch].publish(event_type, data, branch=g.branch)
+
+@after_commit
+def record_popularity(service_name, delta=1, timestamp=None):
+    # Название услуги приходит от клиента: учитываются только услуги каталога
+    if service_name in catalog.snapshot().by_name:
+        popularity.record(service_name, delta, timestamp=timestamp)
+
+def idempotent(view):
+    """Поддержка заголовка Idempotency-Key: повтор запроса с тем же ключом
+    возвращает сохраненный ответ, не выполняя запись повторно"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        
+        store = idempotency[g.branch]
+        request_hash = hashlib.sha256(
+            request.method.encode() + request.path.encode() + b'\n' + request.get_data()
+        ).hexdigest()
+        
+        state, record = store.begin(key, request_hash)
+        if state == IdempotencyStore.CONFLICT:
+            return jsonify({'success': False, 'error': 'Idempotency-Key reused with a different request'}), 422
+        if state == IdempotencyStore.IN_PROGRESS:
+            return jsonify({'success': False, 'error': 'Request with this Idempotency-Key is in progress'}), 409
+        if state == IdempotencyStore.REPLAY:
+            response = app.response_class(record['response_body'], status=record['status_code'], mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            store.release(key, request_hash)
+            raise
+        
+        # Ошибки сервера не сохраняем: клиент может повторить запрос. Сбои после
+        # фиксации записи (after_commit) до 500 не доходят, так что ключ
+        # освобождается, только если сама запись не выполнена
+        if response.status_code >= 500:
+            store.release(key, request_hash)
+        else:
+            store.complete(key, request_hash, response.status_code, response.get_data(as_text=True))
+        return response
+    
+    return wrapper
+
 # Роуты для услуг
 @app.route('/api/services', methods=['GET'])
 def get_services():
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
         category = request.args.get('category')
         popular = request.args.get('popular')
+        sort = request.args.get('sort', 'default')
         
-        query = "SELECT * FROM services WHERE active = TRUE"
-        params = []
+        if not category or category == 'all':
+            category = None
         
-        if category and category != 'all':
-            query += " AND category = ?"
-            params.append(category)
+        if sort not in ('default', 'popular'):
+            return jsonify({'success': False, 'error': f'Unknown sort: {sort}'}), 400
         
-        if popular == 'true':
-            query += " AND popular = TRUE"
-        
-        query += " ORDER BY popular DESC, name ASC"
-        
-        cursor.execute(query, params)
-        services = [row_to_service(row) for row in cursor.fetchall()]
-        
-        conn.close()
-        return jsonify({'success': True, 'data': services})
+        body = catalog.snapshot().list_body(category, popular == 'true', sort)
+        return app.response_class(body, mimetype='application/json')
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -94,18 +234,12 @@ def get_services():
 @app.route('/api/services/<int:service_id>', methods=['GET'])
 def get_service(service_id):
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM services WHERE id = ? AND active = TRUE", (service_id,))
-        row = cursor.fetchone()
+        body = catalog.snapshot().item_body(service_id)
         
-        if not row:
+        if body is None:
             return jsonify({'success': False, 'error': 'Service not found'}), 404
         
-        service = row_to_service(row)
-        conn.close()
-        return jsonify({'success': True, 'data': service})
+        return app.response_class(body, mimetype='application/json')
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -114,7 +248,7 @@ def get_service(service_id):
 @app.route('/api/reviews', methods=['GET'])
 def get_reviews():
     try:
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         rating = request.args.get('rating')
@@ -122,7 +256,9 @@ def get_reviews():
         per_page = int(request.args.get('per_page', 6))
         offset = (page - 1) * per_page
         
-        query = "SELECT * FROM reviews WHERE approved = TRUE"
+        fields = requested_fields(REVIEW_FIELDS, REVIEW_SUMMARY)
+        
+        query = f"SELECT {', '.join(fields)} FROM reviews WHERE approved = TRUE"
         params = []
         
         if rating and rating != 'all':
@@ -133,34 +269,22 @@ def get_reviews():
         params.extend([per_page, offset])
         
         cursor.execute(query, params)
-        reviews = [row_to_review(row) for row in cursor.fetchall()]
-        
-        # Получаем общее количество для пагинации
-        count_query = "SELECT COUNT(*) FROM reviews WHERE approved = TRUE"
-        if rating and rating != 'all':
-            count_query += " AND rating = ?"
-            cursor.execute(count_query, (int(rating),))
-        else:
-            cursor.execute(count_query)
-        
-        total_count = cursor.fetchone()[0]
+        reviews = [project_row(fields, row) for row in cursor.fetchall()]
         
-        # Статистика по рейтингам
-        cursor.execute('''
-            SELECT rating, COUNT(*) as count 
-            FROM reviews 
-            WHERE approved = TRUE 
-            GROUP BY rating 
-            ORDER BY rating DESC
-        ''')
+        # Статистика по рейтингам (поддерживается модерацией, без агрегации по отзывам)
+        cursor.execute("SELECT rating, count FROM review_stats WHERE count > 0 ORDER BY rating DESC")
         rating_stats = {row[0]: row[1] for row in cursor.fetchall()}
         
-        # Средний рейтинг
-        cursor.execute("SELECT AVG(rating) FROM reviews WHERE approved = TRUE")
-        avg_rating = cursor.fetchone()[0] or 0
-        
         conn.close()
         
+        # Общее количество для пагинации и средний рейтинг
+        approved_count = sum(rating_stats.values())
+        if rating and rating != 'all':
+            total_count = rating_stats.get(int(rating), 0)
+        else:
+            total_count = approved_count
+        avg_rating = sum(r * c for r, c in rating_stats.items()) / approved_count if approved_count else 0
+        
         return jsonify({
             'success': True, 
             'data': reviews,
@@ -177,6 +301,8 @@ def get_reviews():
             }
         })
     
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -190,7 +316,7 @@ def create_review():
             if field not in data:
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -210,28 +336,129 @@ def create_review():
         review_id = cursor.lastrowid
         conn.close()
         
+        publish_event('review.created', {
+            'id': review_id,
+            'author_name': data['author_name'],
+            'rating': data['rating']
+        })
+        
         return jsonify({'success': True, 'message': 'Review submitted for moderation', 'id': review_id})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Модерация отзывов
+@app.route('/api/admin/reviews', methods=['GET'])
+def get_pending_reviews():
+    try:
+        cursor_id = int(request.args.get('cursor', 0))
+        limit = min(int(request.args.get('limit', 20)), 100)
+        
+        conn = branch_db().get_connection()
+        cursor = conn.cursor()
+        
+        # Курсорная пагинация по частичному индексу idx_reviews_pending
+        cursor.execute(f'''
+            SELECT {', '.join(REVIEW_FIELDS)} FROM reviews
+            WHERE approved = FALSE AND rejected = FALSE AND id > ?
+            ORDER BY id LIMIT ?
+        ''', (cursor_id, limit + 1))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        reviews = [project_row(REVIEW_FIELDS, row) for row in rows[:limit]]
+        next_cursor = reviews[-1]['id'] if len(rows) > limit else None
+        
+        return jsonify({'success': True, 'data': reviews, 'next_cursor': next_cursor})
+    
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/admin/reviews', methods=['POST'])
+def moderate_reviews():
+    try:
+        data = request.get_json()
+        
+        action = data.get('action')
+        ids = data.get('ids')
+        if action not in ('approve', 'reject'):
+            return jsonify({'success': False, 'error': 'action must be approve or reject'}), 400
+        if not ids or not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            return jsonify({'success': False, 'error': 'ids must be a non-empty list of integers'}), 400
+        if len(ids) > 500:
+            return jsonify({'success': False, 'error': 'At most 500 ids per request'}), 400
+        
+        ids = list(dict.fromkeys(ids))
+        placeholders = ', '.join('?' for _ in ids)
+        
+        conn = branch_db().get_connection()
+        cursor = conn.cursor()
+        
+        # Весь пакет - одна транзакция. Отклоненный отзыв остается в базе
+        # и может быть одобрен позже
+        if action == 'approve':
+            # Счетчики по оценкам корректируются один раз на пакет
+            cursor.execute(f'''
+                INSERT INTO review_stats (rating, count)
+                SELECT rating, COUNT(*) FROM reviews
+                WHERE id IN ({placeholders}) AND approved = FALSE
+                GROUP BY rating
+                ON CONFLICT(rating) DO UPDATE SET count = count + excluded.count
+            ''', ids)
+            cursor.execute(
+                f"UPDATE reviews SET approved = TRUE, rejected = FALSE WHERE id IN ({placeholders}) AND approved = FALSE",
+                ids
+            )
+        else:
+            cursor.execute(
+                f"UPDATE reviews SET rejected = TRUE WHERE id IN ({placeholders}) AND approved = FALSE AND rejected = FALSE",
+                ids
+            )
+        
+        updated = cursor.rowcount
+        conn.commit()
+        conn.close()
+        
+        publish_event('review.moderated', {'action': action, 'ids': ids, 'updated': updated})
+        
+        return jsonify({'success': True, 'updated': updated})
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # Роуты для записей
 @app.route('/api/bookings', methods=['GET'])
 def get_bookings():
     try:
-        conn = db.get_connection()
+        fields = requested_fields(BOOKING_FIELDS, BOOKING_SUMMARY)
+        
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         date = request.args.get('date')
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
         status = request.args.get('status')
         
-        query = "SELECT * FROM bookings WHERE 1=1"
+        # Старые завершенные записи читаются и из архива, если диапазон их захватывает
+        source = branch_db().archived_source(cursor, 'bookings', date_from=date or date_from, status=status)
+        query = f"SELECT {', '.join(fields)} FROM {source} WHERE 1=1"
         params = []
         
         if date:
             query += " AND booking_date = ?"
             params.append(date)
         
+        if date_from:
+            query += " AND booking_date >= ?"
+            params.append(date_from)
+        
+        if date_to:
+            query += " AND booking_date <= ?"
+            params.append(date_to)
+        
         if status:
             query += " AND status = ?"
             params.append(status)
@@ -239,15 +466,18 @@ def get_bookings():
         query += " ORDER BY booking_date, booking_time"
         
         cursor.execute(query, params)
-        bookings = [row_to_booking(row) for row in cursor.fetchall()]
+        bookings = [project_row(fields, row) for row in cursor.fetchall()]
         
         conn.close()
         return jsonify({'success': True, 'data': bookings})
     
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/bookings', methods=['POST'])
+@idempotent
 def create_booking():
     try:
         data = request.get_json()
@@ -258,7 +488,7 @@ def create_booking():
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
         # Проверяем доступность времени
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -290,6 +520,16 @@ def create_booking():
         booking_id = cursor.lastrowid
         conn.close()
         
+        publish_event('booking.created', {
+            'id': booking_id,
+            'customer_name': data['customer_name'],
+            'service_name': data['service_name'],
+            'booking_date': data['booking_date'],
+            'booking_time': data['booking_time'],
+            'status': 'pending'
+        })
+        record_popularity(data['service_name'])
+        
         return jsonify({'success': True, 'message': 'Booking created successfully', 'id': booking_id})
     
     except Exception as e:
@@ -300,15 +540,21 @@ def update_booking(booking_id):
     try:
         data = request.get_json()
         
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         # Проверяем существование записи
-        cursor.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,))
-        if not cursor.fetchone():
+        cursor.execute('''
+            SELECT service_name, status, CAST(strftime('%s', created_at) AS REAL)
+            FROM bookings WHERE id = ?
+        ''', (booking_id,))
+        booking = cursor.fetchone()
+        if not booking:
             conn.close()
             return jsonify({'success': False, 'error': 'Booking not found'}), 404
         
+        service_name, old_status, created = booking
+        
         allowed_fields = ['status', 'notes']
         update_fields = []
         params = []
@@ -328,6 +574,16 @@ def update_booking(booking_id):
         conn.commit()
         conn.close()
         
+        publish_event('booking.updated', dict(
+            {field: data[field] for field in allowed_fields if field in data},
+            id=booking_id
+        ))
+        
+        # Отмена снимает вклад записи в популярность, возврат из отмены - восстанавливает
+        new_status = data.get('status', old_status)
+        if (old_status == 'cancelled') != (new_status == 'cancelled'):
+            record_popularity(service_name, -1 if new_status == 'cancelled' else 1, timestamp=created)
+        
         return jsonify({'success': True, 'message': 'Booking updated successfully'})
     
     except Exception as e:
@@ -335,6 +591,7 @@ def update_booking(booking_id):
 
 # Роуты для заказов (корзина)
 @app.route('/api/orders', methods=['POST'])
+@idempotent
 def create_order():
     try:
         data = request.get_json()
@@ -344,7 +601,7 @@ def create_order():
             if field not in data:
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -361,6 +618,12 @@ def create_order():
         order_id = cursor.lastrowid
         conn.close()
         
+        publish_event('order.created', {
+            'id': order_id,
+            'customer_name': data['customer_name'],
+            'total_amount': data['total_amount']
+        })
+        
         return jsonify({'success': True, 'message': 'Order created successfully', 'id': order_id})
     
     except Exception as e:
@@ -369,13 +632,19 @@ def create_order():
 @app.route('/api/orders/<int:order_id>', methods=['GET'])
 def get_order(order_id):
     try:
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         cursor.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
         row = cursor.fetchone()
         
         if not row:
+            # Заказ мог быть перенесен в архив
+            cursor.execute("SELECT * FROM archive.orders WHERE id = ?", (order_id,))
+            row = cursor.fetchone()
+        
+        if not row:
+            conn.close()
             return jsonify({'success': False, 'error': 'Order not found'}), 404
         
         order = row_to_order(row)
@@ -389,6 +658,8 @@ def get_order(order_id):
 @app.route('/api/blog', methods=['GET'])
 def get_blog_posts():
     try:
+        fields = requested_fields(BLOG_FIELDS, BLOG_SUMMARY)
+        
         conn = db.get_connection()
         cursor = conn.cursor()
         
@@ -397,7 +668,8 @@ def get_blog_posts():
         per_page = int(request.args.get('per_page', 6))
         offset = (page - 1) * per_page
         
-        query = "SELECT * FROM blog_posts WHERE published = TRUE"
+        # Краткая форма покрывается индексом idx_blog_posts_list: content не читается
+        query = f"SELECT {', '.join(fields)} FROM blog_posts WHERE published = TRUE"
         params = []
         
         if category != 'all':
@@ -408,20 +680,7 @@ def get_blog_posts():
         params.extend([per_page, offset])
         
         cursor.execute(query, params)
-        posts = []
-        for row in cursor.fetchall():
-            posts.append({
-                'id': row[0],
-                'title': row[1],
-                'excerpt': row[2],
-                'content': row[3],
-                'category': row[4],
-                'author': row[5],
-                'read_time': row[6],
-                'image_url': row[7],
-                'views': row[9],
-                'created_at': row[10]
-            })
+        posts = [project_row(fields, row) for row in cursor.fetchall()]
         
         # Общее количество
         count_query = "SELECT COUNT(*) FROM blog_posts WHERE published = TRUE"
@@ -446,6 +705,8 @@ def get_blog_posts():
             }
         })
     
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -534,7 +795,7 @@ def create_contact():
             if field not in data:
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
-        conn = db.get_connection()
+        conn = branch_db().get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -551,12 +812,37 @@ def create_contact():
         contact_id = cursor.lastrowid
         conn.close()
         
+        publish_event('contact.created', {
+            'id': contact_id,
+            'name': data['name'],
+            'email': data['email']
+        })
+        
         return jsonify({'success': True, 'message': 'Message sent successfully', 'id': contact_id})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # Статистика
+def branch_stats(branch, database):
+    """Статистика одного филиала для сводных отчетов"""
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT SUM(count), SUM(rating * count) FROM review_stats")
+    reviews_count, rating_sum = cursor.fetchone()
+    
+    source = database.archived_source(cursor, 'bookings', status='completed')
+    cursor.execute(f"SELECT COUNT(*) FROM {source} WHERE status = 'completed'")
+    completed_bookings = cursor.fetchone()[0]
+    
+    conn.close()
+    return {
+        'reviews_count': reviews_count or 0,
+        'rating_sum': rating_sum or 0,
+        'completed_bookings': completed_bookings
+    }
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     try:
@@ -567,15 +853,6 @@ def get_stats():
         cursor.execute("SELECT COUNT(*) FROM services WHERE active = TRUE")
         services_count = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) FROM reviews WHERE approved = TRUE")
-        reviews_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM bookings WHERE status = 'completed'")
-        completed_bookings = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT AVG(rating) FROM reviews WHERE approved = TRUE")
-        avg_rating = cursor.fetchone()[0] or 0
-        
         # Статистика по услугам
         cursor.execute('''
             SELECT category, COUNT(*) as count 
@@ -587,6 +864,13 @@ def get_stats():
         
         conn.close()
         
+        # Отзывы и записи собираются со всех филиалов параллельно
+        per_branch = router.fan_out(branch_stats)
+        reviews_count = sum(stats['reviews_count'] for stats in per_branch.values())
+        rating_sum = sum(stats['rating_sum'] for stats in per_branch.values())
+        completed_bookings = sum(stats['completed_bookings'] for stats in per_branch.values())
+        avg_rating = rating_sum / reviews_count if reviews_count else 0
+        
         return jsonify({
             'success': True,
             'data': {
@@ -601,5 +885,180 @@ def get_stats():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/reports/bookings', methods=['GET'])
+def get_bookings_report():
+    try:
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+        
+        query = "SELECT status, COUNT(*), SUM(service_price) FROM {source} WHERE 1=1"
+        params = []
+        
+        if date_from:
+            query += " AND booking_date >= ?"
+            params.append(date_from)
+        
+        if date_to:
+            query += " AND booking_date <= ?"
+            params.append(date_to)
+        
+        query += " GROUP BY status"
+        
+        def branch_report(branch, database):
+            conn = database.get_connection()
+            cursor = conn.cursor()
+            source = database.archived_source(cursor, 'bookings', date_from=date_from)
+            cursor.execute(query.format(source=source), params)
+            rows = cursor.fetchall()
+            conn.close()
+            return {status: {'count': count, 'revenue': revenue or 0} for status, count, revenue in rows}
+        
+        per_branch = router.fan_out(branch_report)
+        
+        # Слияние результатов филиалов
+        totals = {}
+        for report in per_branch.values():
+            for status, values in report.items():
+                total = totals.setdefault(status, {'count': 0, 'revenue': 0})
+                total['count'] += values['count']
+                total['revenue'] += values['revenue']
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'by_status': totals,
+                'by_branch': per_branch
+            }
+        })
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Лента событий (Server-Sent Events)
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid Last-Event-ID'}), 400
+    
+    # Фильтр по типам: ?types=booking,review. Лента и Last-Event-ID - свои у каждого филиала
+    types = [t for t in request.args.get('types', '').split(',') if t]
+    subscription = events[g.branch].subscribe(last_event_id, types)
+    
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            for event in subscription.events():
+                yield EventBroker.format_sse(event)
+        finally:
+            subscription.close()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Профилирование SQL
+def check_debug_token():
+    """Доступ к /debug/sql только с токеном SQL_PROFILE_TOKEN в заголовке X-Debug-Token"""
+    if db.profiler is None:
+        return jsonify({'success': False, 'error': 'SQL profiler is disabled'}), 404
+    
+    token = os.environ.get('SQL_PROFILE_TOKEN')
+    if not token or not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), token):
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+    return None
+
+@app.route('/debug/sql', methods=['GET'])
+def get_sql_profile():
+    denied = check_debug_token()
+    if denied:
+        return denied
+    
+    report = db.profiler.report()
+    if request.args.get('format') == 'text':
+        return app.response_class(SQLProfiler.format_report(report), mimetype='text/plain')
+    
+    return jsonify({'success': True, 'data': report})
+
+@app.route('/debug/sql/reset', methods=['POST'])
+def reset_sql_profile():
+    denied = check_debug_token()
+    if denied:
+        return denied
+    
+    db.profiler.reset()
+    return jsonify({'success': True, 'message': 'SQL profile reset'})
+
+@app.cli.command('sql-report')
+@click.argument('dump_file', required=False)
+@click.option('--limit', default=20, help='Number of fingerprints to show')
+def sql_report(dump_file, limit):
+    """Print the SQL profiler report saved via SQL_PROFILE_DUMP."""
+    dump_file = dump_file or os.environ.get('SQL_PROFILE_DUMP')
+    if not dump_file:
+        raise click.UsageError('Pass DUMP_FILE or set SQL_PROFILE_DUMP')
+    
+    with open(dump_file, encoding='utf-8') as f:
+        report = json.load(f)
+    click.echo(SQLProfiler.format_report(report, limit=limit))
+
+# Архивация старых записей и заказов
+@app.cli.command('archive')
+@click.option('--days', default=365, help='Archive terminal rows older than this many days')
+@click.option('--batch-size', default=500, help='Rows moved per transaction')
+def archive_command(days, batch_size):
+    """Move completed/cancelled bookings and orders to the archive database."""
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    for branch, database in router.shards.items():
+        moved = database.archive(cutoff, batch_size=batch_size)
+        click.echo(f"{branch}: " + ', '.join(f"{table} {count}" for table, count in moved.items()))
+
+# Резервное копирование
+@app.cli.command('backup')
+def backup_command():
+    """Back up all databases online and rotate old backups."""
+    for path in backups.run_once():
+        click.echo(path)
+
+@app.cli.command('restore')
+@click.argument('backup_file')
+@click.option('--branch', default=None, help='Branch to restore (defaults to the catalog database)')
+def restore_command(backup_file, branch):
+    """Restore a database from a verified backup file."""
+    if branch and branch not in router:
+        raise click.BadParameter(f'Unknown branch: {branch}', param_hint='--branch')
+    database = router.get(branch) if branch else db
+    database.restore(backup_file)
+    click.echo(f'Restored {database.db_path} from {backup_file}')
+
+# Счетчики отзывов
+@app.cli.command('review-stats')
+def review_stats_command():
+    """Recount approved reviews per rating after reviews were edited outside the API."""
+    for branch, database in router.shards.items():
+        conn = database.get_connection()
+        cursor = conn.cursor()
+        Database.rebuild_review_stats(cursor)
+        conn.commit()
+        cursor.execute("SELECT SUM(count) FROM review_stats")
+        click.echo(f"{branch}: {cursor.fetchone()[0] or 0} approved reviews")
+        conn.close()
+
+# Рейтинг популярности услуг
+@app.cli.command('popularity')
+@click.option('--rebuild', is_flag=True, help='Recompute counters from the booking history of all branches')
+def popularity_command(rebuild):
+    """Fold booking counters into the service popularity ranking."""
+    if rebuild:
+        count = popularity.rebuild(router.shards.values())
+        click.echo(f'Rebuilt counters for {count} services')
+    click.echo(f'Updated {popularity.fold()} services')
+    for name, score in sorted(popularity.scores().items(), key=lambda item: -item[1]):
+        click.echo(f'{score:10.2f}  {name}')
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
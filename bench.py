@@ -0,0 +1,156 @@
+"""Бенчмарки салона.
+
+Запуск: python bench.py <сценарий> [параметры]. Каждый сценарий работает
+во временном каталоге и не трогает рабочую базу.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def load_app():
+    """Импорт приложения с базой во временном каталоге"""
+    os.chdir(tempfile.mkdtemp(prefix='salon-bench-'))
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def bench_backup(args):
+    """Задержка записи под постоянной нагрузкой без резервного копирования и во время него"""
+    app = load_app()
+    database = app.db
+
+    # Наполняем базу, чтобы копирование шло заметное время
+    conn = database.get_connection()
+    conn.executemany(
+        "INSERT INTO orders (customer_name, customer_phone, total_amount, items_json, status) VALUES (?, ?, ?, ?, 'completed')",
+        [(f'Клиент {i}', '+7900000000', 1000, '[{"id": 1, "qty": 2}]' * 10) for i in range(args.rows)]
+    )
+    conn.commit()
+    conn.close()
+
+    def measure(during):
+        latencies = []
+        stop = threading.Event()
+
+        def writer():
+            conn = database.get_connection()
+            while not stop.is_set():
+                start = time.perf_counter()
+                conn.execute(
+                    "INSERT INTO orders (customer_name, customer_phone, total_amount, items_json) VALUES ('bench', '1', 1, '[]')"
+                )
+                conn.commit()
+                latencies.append((time.perf_counter() - start) * 1000)
+                time.sleep(args.write_interval / 1000)
+            conn.close()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        start = time.perf_counter()
+        if during is None:
+            time.sleep(args.baseline)
+        else:
+            during()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        thread.join()
+        return elapsed, latencies
+
+    backup_dir = os.path.join(os.getcwd(), 'backups')
+    scenarios = [
+        ('no backup', None),
+        ('backup', lambda: database.backup(backup_dir, pages=args.pages, sleep=args.sleep / 1000)),
+        ('file copy', lambda: copy_locked(database))
+    ]
+
+    print(f"{'scenario':<10} {'seconds':>8} {'writes':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for name, during in scenarios:
+        elapsed, latencies = measure(during)
+        print(f"{name:<10} {elapsed:>8.2f} {len(latencies):>8} {statistics.median(latencies):>8.2f} "
+              f"{percentile(latencies, 0.95):>8.2f} {max(latencies):>8.2f}")
+
+def copy_locked(database):
+    """Старый способ: копирование файла под эксклюзивной блокировкой"""
+    import shutil
+    conn = sqlite3.connect(database.db_path, isolation_level=None)
+    conn.execute("BEGIN EXCLUSIVE")
+    shutil.copyfile(database.db_path, database.db_path + '.copy')
+    conn.execute("ROLLBACK")
+    conn.close()
+
+def bench_projection(args):
+    """Размер ответа и задержка списка статей: полные строки против краткой формы"""
+    app = load_app()
+
+    paragraph = ('Правильный уход за шерстью собаки - это не только вопрос эстетики, '
+                 'но и важная составляющая здоровья вашего питомца. ') * 4
+    categories = ['care', 'nutrition', 'health', 'training']
+    conn = app.db.get_connection()
+    conn.executemany(
+        "INSERT INTO blog_posts (title, excerpt, content, category, author, read_time, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                f'Статья {i}',
+                'Краткое описание статьи для карточки в списке блога.',
+                '\n\n'.join([paragraph] * random.randint(10, 30)),
+                categories[i % len(categories)],
+                'Мария Иванова',
+                f'{random.randint(3, 15)} мин',
+                f'2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00'
+            )
+            for i in range(args.posts)
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+    test_client = app.app.test_client()
+    pages = range(1, args.pages + 1)
+    print(f"{'shape':<8} {'avg KB/page':>12} {'p50 ms':>8} {'p95 ms':>8}")
+    for shape, extra in (('full', '&fields=all'), ('summary', '')):
+        sizes, latencies = [], []
+        for _ in range(args.rounds):
+            for page in pages:
+                start = time.perf_counter()
+                response = test_client.get(f'/api/blog?per_page={args.per_page}&page={page}{extra}')
+                latencies.append((time.perf_counter() - start) * 1000)
+                sizes.append(len(response.get_data()))
+        print(f"{shape:<8} {statistics.mean(sizes) / 1024:>12.1f} {statistics.median(latencies):>8.2f} "
+              f"{percentile(latencies, 0.95):>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backup = commands.add_parser('backup', help=bench_backup.__doc__)
+    backup.add_argument('--rows', type=int, default=200000)
+    backup.add_argument('--pages', type=int, default=64)
+    backup.add_argument('--sleep', type=float, default=5, help='Pause between backup steps, ms')
+    backup.add_argument('--baseline', type=float, default=3, help='Baseline duration, s')
+    backup.add_argument('--write-interval', type=float, default=2, help='Pause between writes, ms')
+    backup.set_defaults(func=bench_backup)
+
+    projection = commands.add_parser('projection', help=bench_projection.__doc__)
+    projection.add_argument('--posts', type=int, default=10000)
+    projection.add_argument('--per-page', type=int, default=20)
+    projection.add_argument('--pages', type=int, default=50)
+    projection.add_argument('--rounds', type=int, default=3)
+    projection.set_defaults(func=bench_projection)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,593 @@
 import sqlite3
+import glob
 import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from types import MappingProxyType
 from typing import List, Dict, Optional
 
+# Профилирование SQL
+class SQLProfiler:
+    """Профилировщик SQL: агрегирует время выполнения по отпечаткам запросов
+    и ведет журнал медленных запросов с их планом выполнения"""
+    
+    # Шаг обработчика прогресса SQLite (в инструкциях VM)
+    PROGRESS_STEP = 1000
+    
+    _COMMENT_RE = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+    _STRING_RE = re.compile(r"'(?:[^']|'')*'")
+    _NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+    _BOOL_RE = re.compile(r'\b(?:TRUE|FALSE)\b', re.I)
+    _IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+    _SPACE_RE = re.compile(r'\s+')
+    
+    def __init__(self, slow_threshold_ms=100, slow_log_size=100):
+        self.slow_threshold = slow_threshold_ms / 1000.0
+        self._stats = {}
+        self._slow_log = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def fingerprint(cls, sql):
+        """Нормализация запроса: литералы заменяются на ?, пробелы схлопываются"""
+        sql = cls._COMMENT_RE.sub(' ', sql)
+        sql = cls._STRING_RE.sub('?', sql)
+        sql = cls._NUMBER_RE.sub('?', sql)
+        sql = cls._BOOL_RE.sub('?', sql)
+        sql = cls._IN_LIST_RE.sub('IN (...)', sql)
+        return cls._SPACE_RE.sub(' ', sql).strip()
+    
+    def attach(self, conn):
+        """Подключение обработчика прогресса к соединению"""
+        conn.profiler = self
+        conn.vm_steps = 0
+        conn.open_cursors = set()
+        
+        def progress():
+            conn.vm_steps += self.PROGRESS_STEP
+            return 0
+        
+        conn.set_progress_handler(progress, self.PROGRESS_STEP)
+    
+    def record(self, conn, sql, params, elapsed, vm_steps):
+        fingerprint = self.fingerprint(sql)
+        
+        with self._lock:
+            stat = self._stats.get(fingerprint)
+            if stat is None:
+                stat = self._stats[fingerprint] = {
+                    'count': 0, 'total_time': 0.0, 'max_time': 0.0, 'vm_steps': 0
+                }
+            stat['count'] += 1
+            stat['total_time'] += elapsed
+            stat['max_time'] = max(stat['max_time'], elapsed)
+            stat['vm_steps'] += vm_steps
+        
+        # В журнал попадает только отпечаток: значения параметров (имена, телефоны) не сохраняются
+        if elapsed >= self.slow_threshold:
+            entry = {
+                'fingerprint': fingerprint,
+                'time_ms': round(elapsed * 1000, 3),
+                'query_plan': self.explain(conn, sql, params),
+                'logged_at': datetime.now().isoformat()
+            }
+            with self._lock:
+                self._slow_log.append(entry)
+    
+    @staticmethod
+    def explain(conn, sql, params):
+        """EXPLAIN QUERY PLAN для медленного запроса (без профилирования)"""
+        try:
+            cursor = sqlite3.Cursor(conn)
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params or ())
+            return [row[3] for row in cursor.fetchall()]
+        except sqlite3.Error:
+            return None
+    
+    def report(self):
+        with self._lock:
+            queries = [
+                {
+                    'fingerprint': fingerprint,
+                    'count': stat['count'],
+                    'total_ms': round(stat['total_time'] * 1000, 3),
+                    'avg_ms': round(stat['total_time'] * 1000 / stat['count'], 3),
+                    'max_ms': round(stat['max_time'] * 1000, 3),
+                    'vm_steps': stat['vm_steps']
+                }
+                for fingerprint, stat in self._stats.items()
+            ]
+            slow_queries = list(self._slow_log)
+        
+        queries.sort(key=lambda q: q['total_ms'], reverse=True)
+        return {
+            'slow_threshold_ms': self.slow_threshold * 1000,
+            'queries': queries,
+            'slow_queries': slow_queries
+        }
+    
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._slow_log.clear()
+    
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+    
+    @staticmethod
+    def format_report(report, limit=20):
+        """Текстовое представление отчета для консоли"""
+        lines = [f"{'count':>8} {'total ms':>12} {'avg ms':>10} {'max ms':>10}  query"]
+        for q in report['queries'][:limit]:
+            lines.append(f"{q['count']:>8} {q['total_ms']:>12.3f} {q['avg_ms']:>10.3f} {q['max_ms']:>10.3f}  {q['fingerprint']}")
+        
+        if report['slow_queries']:
+            lines.append('')
+            lines.append(f"Медленные запросы (>= {report['slow_threshold_ms']:g} ms):")
+            for entry in report['slow_queries']:
+                lines.append(f"  {entry['time_ms']:.3f} ms  {entry['fingerprint']}")
+                for step in entry['query_plan'] or []:
+                    lines.append(f"      {step}")
+        return '\n'.join(lines)
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Курсор, учитывающий весь запрос: execute() возвращает управление после
+    первой строки, остальные SQLite выбирает при fetch*. Запись закрывается,
+    когда строки выбраны до конца, при следующем execute, закрытии курсора
+    или возврате соединения в пул"""
+    _pending = None
+    
+    def _begin(self, sql, parameters):
+        self.finish()
+        self._pending = [sql, parameters, 0.0, 0]
+        self.connection.open_cursors.add(self)
+    
+    def _timed(self, method, *args):
+        conn = self.connection
+        pending = self._pending
+        steps = conn.vm_steps
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if pending is not None:
+                pending[2] += time.perf_counter() - start
+                pending[3] += conn.vm_steps - steps
+    
+    def finish(self):
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            conn = self.connection
+            conn.open_cursors.discard(self)
+            conn.profiler.record(conn, *pending)
+    
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        try:
+            self._timed(super().execute, sql, parameters)
+        except BaseException:
+            self.finish()
+            raise
+        if self.description is None:
+            self.finish()
+        return self
+    
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, None)
+        try:
+            return self._timed(super().executemany, sql, seq_of_parameters)
+        finally:
+            self.finish()
+    
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self.finish()
+        return row
+    
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if len(rows) < size:
+            self.finish()
+        return rows
+    
+    def fetchall(self):
+        try:
+            return self._timed(super().fetchall)
+        finally:
+            self.finish()
+    
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self.finish()
+            raise
+    
+    def close(self):
+        self.finish()
+        super().close()
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение, которое при close() возвращается в пул своей базы"""
+    pool = None
+    
+    def close(self):
+        if self.pool is not None:
+            try:
+                if self.in_transaction:
+                    self.rollback()
+                self.pool.put_nowait(self)
+                return
+            except (queue.Full, sqlite3.Error):
+                pass
+        super().close()
+
+class ProfiledConnection(PooledConnection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+    
+    # Connection.execute() создает обычный курсор в обход cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def close(self):
+        for cursor in list(self.open_cursors):
+            cursor.finish()
+        super().close()
+
+# Резервное копирование по расписанию
+class BackupScheduler:
+    """Фоновое резервное копирование баз с ротацией старых копий"""
+    
+    def __init__(self, databases, backup_dir='backups', interval=3600, keep=7):
+        self.databases = databases
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def run_once(self):
+        paths = []
+        for database in self.databases:
+            paths.append(database.backup(self.backup_dir))
+            database.rotate_backups(self.backup_dir, keep=self.keep)
+        return paths
+    
+    def start(self):
+        if self._thread is not None:
+            return
+        
+        def loop():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.run_once()
+                    self.last_error = None
+                except (sqlite3.Error, OSError) as e:
+                    self.last_error = str(e)
+        
+        self._thread = threading.Thread(target=loop, name='backup-scheduler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+
+# Архивируемые таблицы: выражение даты строки и конечные статусы
+ARCHIVE_TABLES = {
+    'bookings': ('booking_date', ('completed', 'cancelled')),
+    'orders': ('date(created_at)', ('completed', 'cancelled'))
+}
+
 class Database:
-    def __init__(self, db_path='grooming_salon.db'):
+    def __init__(self, db_path='grooming_salon.db', profiler=None, pool_size=5, seed=True, catalog=True, branch=True):
         self.db_path = db_path
+        self.archive_path = os.path.splitext(db_path)[0] + '_archive.db'
+        self.seed = seed
+        # Состав базы: общий каталог (услуги, блог, галерея) и/или таблицы филиала.
+        # Без шардирования в одной базе есть и то и другое
+        self.catalog = catalog
+        self.branch = branch
+        
+        # Профилирование включается явно или через SQL_PROFILE=1
+        if profiler is None and os.environ.get('SQL_PROFILE') == '1':
+            profiler = SQLProfiler(slow_threshold_ms=float(os.environ.get('SQL_SLOW_MS', 100)))
+        self.profiler = profiler
+        
+        # Пул соединений этой базы (0 - без пула)
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue(maxsize=pool_size) if pool_size else None
+        
         self.init_database()
     
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        if self._pool is not None:
+            try:
+                return self._pool.get_nowait()
+            except queue.Empty:
+                pass
+        
+        factory = PooledConnection if self.profiler is None else ProfiledConnection
+        conn = sqlite3.connect(self.db_path, factory=factory, check_same_thread=False)
+        if self.profiler is not None:
+            self.profiler.attach(conn)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        conn.pool = self._pool
+        return conn
+    
+    def archived_source(self, cursor, table, date_from=None, status=None):
+        """Источник строк для чтения: горячая таблица или ее объединение с архивом,
+        если запрошенный диапазон дат и статус могут попасть в архив"""
+        date_expr, statuses = ARCHIVE_TABLES[table]
+        if status is not None and status not in statuses:
+            return table
+        
+        cursor.execute("SELECT cutoff FROM archive.archive_state WHERE table_name = ?", (table,))
+        row = cursor.fetchone()
+        if row is None or (date_from is not None and date_from >= row[0]):
+            return table
+        
+        # Строка, уже скопированная в архив, но еще не удаленная из горячей таблицы
+        # (между шагами архивации), читается только из горячей таблицы
+        return (
+            f"(SELECT * FROM main.{table} UNION ALL "
+            f"SELECT * FROM archive.{table} WHERE id NOT IN (SELECT id FROM main.{table}))"
+        )
+    
+    def archive(self, cutoff, batch_size=500, pause=0.05):
+        """Перенос строк в конечном статусе старше cutoff (YYYY-MM-DD) в архивную базу.
+        Обе базы в режиме WAL, а в нем транзакция над несколькими файлами атомарна
+        только пофайлово, поэтому каждая пачка переносится в два шага с отдельными
+        короткими транзакциями: копирование в архив, затем удаление из основной базы
+        уже скопированных строк. Сбой между шагами оставляет лишь копию, которую
+        повторный запуск (OR REPLACE) дочищает. В конце освобождается место; первый
+        запуск на базе без auto_vacuum выполняет полный VACUUM main, который блокирует
+        запись на все время перестройки файла"""
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        cursor = conn.cursor()
+        moved = {}
+        
+        try:
+            for table, (date_expr, statuses) in ARCHIVE_TABLES.items():
+                placeholders = ', '.join('?' for _ in statuses)
+                moved[table] = 0
+                
+                while True:
+                    cursor.execute(f'''
+                        SELECT id FROM main.{table}
+                        WHERE status IN ({placeholders}) AND {date_expr} < ?
+                        ORDER BY id LIMIT ?
+                    ''', (*statuses, cutoff, batch_size))
+                    ids = [row[0] for row in cursor.fetchall()]
+                    id_list = ', '.join('?' for _ in ids)
+                    # Статус строки мог измениться после выборки id: условие проверяется
+                    # заново и при копировании, и при удалении
+                    condition = f"id IN ({id_list}) AND status IN ({placeholders}) AND {date_expr} < ?"
+                    params = (*ids, *statuses, cutoff)
+                    
+                    # Шаг 1: копирование в архив. Отложенный BEGIN блокирует на запись
+                    # только файл архива (IMMEDIATE занял бы и основную базу).
+                    # OR REPLACE: повторный запуск после сбоя не дублирует строки,
+                    # а копия строки, вернувшейся из конечного статуса, обновляется
+                    cursor.execute("BEGIN")
+                    try:
+                        copied = 0
+                        if ids:
+                            cursor.execute(f"INSERT OR REPLACE INTO archive.{table} SELECT * FROM main.{table} WHERE {condition}", params)
+                            copied = cursor.rowcount
+                        
+                        cursor.execute('''
+                            INSERT INTO archive.archive_state (table_name, cutoff, archived_rows)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT(table_name) DO UPDATE SET
+                                cutoff = MAX(cutoff, excluded.cutoff),
+                                archived_rows = archived_rows + excluded.archived_rows,
+                                updated_at = CURRENT_TIMESTAMP
+                        ''', (table, cutoff, copied))
+                        cursor.execute("COMMIT")
+                    except Exception:
+                        cursor.execute("ROLLBACK")
+                        raise
+                    
+                    # Шаг 2: удаление из основной базы только тех строк, что уже есть в архиве
+                    # и по-прежнему подходят под условие
+                    if ids:
+                        cursor.execute("BEGIN IMMEDIATE")
+                        try:
+                            cursor.execute(f'''
+                                DELETE FROM main.{table}
+                                WHERE {condition} AND id IN (SELECT id FROM archive.{table})
+                            ''', params)
+                            moved[table] += cursor.rowcount
+                            cursor.execute("COMMIT")
+                        except Exception:
+                            cursor.execute("ROLLBACK")
+                            raise
+                    
+                    if len(ids) < batch_size:
+                        break
+                    time.sleep(pause)
+            
+            # Базы, созданные до включения auto_vacuum, переводятся один раз полным VACUUM
+            cursor.execute("PRAGMA main.auto_vacuum")
+            if cursor.fetchone()[0] != 2:
+                cursor.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+                cursor.execute("VACUUM main")
+            cursor.execute("PRAGMA main.incremental_vacuum")
+            cursor.fetchall()
+        finally:
+            conn.close()
+        
+        return moved
+    
+    def backup(self, backup_dir='backups', pages=64, sleep=0.05):
+        """Онлайн-резервная копия через backup API SQLite: страницы копируются
+        небольшими порциями с паузами, так что писатели не блокируются надолго.
+        Источник держит одну транзакцию чтения на все копирование, поэтому
+        контрольная точка WAL в это время не может завершиться и WAL растет
+        на объем записей за время копирования.
+        Копия проверяется integrity_check и только затем получает итоговое имя"""
+        os.makedirs(backup_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(self.db_path))[0]
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        target = os.path.join(backup_dir, f'{stem}-{stamp}.db')
+        
+        for source_path, target_path in (
+            (self.db_path, target),
+            (self.archive_path, os.path.splitext(target)[0] + '_archive.db')
+        ):
+            if not os.path.exists(source_path):
+                continue
+            
+            partial = target_path + '.partial'
+            src = sqlite3.connect(source_path, isolation_level=None)
+            dst = sqlite3.connect(partial)
+            try:
+                # Открытая транзакция чтения фиксирует снимок WAL: копия согласована
+                # и не перезапускается из-за записей других соединений
+                src.execute("BEGIN")
+                src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                # sleep у backup() срабатывает только при BUSY, пауза между шагами - через progress
+                src.backup(dst, pages=pages, progress=lambda status, remaining, total: time.sleep(sleep))
+                self.verify(dst)
+            except Exception:
+                dst.close()
+                os.remove(partial)
+                raise
+            finally:
+                src.close()
+            dst.close()
+            os.replace(partial, target_path)
+        
+        return target
+    
+    @staticmethod
+    def verify(conn):
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+        if result != [('ok',)]:
+            raise sqlite3.DatabaseError('Integrity check failed: ' + '; '.join(row[0] for row in result[:5]))
+    
+    @staticmethod
+    def list_backups(backup_dir, stem):
+        """Резервные копии базы от новых к старым"""
+        paths = glob.glob(os.path.join(backup_dir, f'{stem}-*.db'))
+        return sorted((p for p in paths if not p.endswith('_archive.db')), reverse=True)
+    
+    def rotate_backups(self, backup_dir='backups', keep=7):
+        stem = os.path.splitext(os.path.basename(self.db_path))[0]
+        removed = []
+        for path in self.list_backups(backup_dir, stem)[keep:]:
+            for file_path in (path, os.path.splitext(path)[0] + '_archive.db'):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            removed.append(path)
+        return removed
+    
+    def restore(self, backup_path, pages=256):
+        """Восстановление базы вместе с архивом из резервной копии. Если архива
+        в копии нет, текущий архив очищается: его строки и граница архивации
+        должны соответствовать восстановленной базе"""
+        if not os.path.exists(backup_path):
+            raise FileNotFoundError(backup_path)
+        
+        archive_backup = os.path.splitext(backup_path)[0] + '_archive.db'
+        sources = [backup_path] + ([archive_backup] if os.path.exists(archive_backup) else [])
+        
+        # Обе копии проверяются до того, как что-либо перезаписано
+        for source_path in sources:
+            src = sqlite3.connect(source_path)
+            try:
+                self.verify(src)
+            finally:
+                src.close()
+        
+        for source_path, target_path in (
+            (backup_path, self.db_path),
+            (archive_backup if archive_backup in sources else ':memory:', self.archive_path)
+        ):
+            src = sqlite3.connect(source_path)
+            dst = sqlite3.connect(target_path)
+            try:
+                src.backup(dst, pages=pages)
+            finally:
+                src.close()
+                dst.close()
+        
+        # Соединения пула могли закэшировать старую схему; пустой архив получает таблицы заново
+        self.close_pool()
+        self.init_database()
+
+    def close_pool(self):
+        """Закрытие всех простаивающих соединений пула"""
+        while self._pool is not None:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.pool = None
+            conn.close()
     
     def init_database(self):
         """Инициализация базы данных и создание таблиц"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Новые базы создаются с инкрементальной очисткой (нужна после архивации)
+        cursor.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+        
+        # WAL: читатели не блокируются писателем
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA archive.journal_mode = WAL")
+        
+        if self.catalog:
+            self.create_catalog_tables(cursor)
+        if self.branch:
+            self.create_branch_tables(cursor)
+        
+        # Вставляем начальные данные
+        if self.seed:
+            self.insert_initial_data(cursor)
+        
+        if self.branch:
+            # Очередь модерации: частичный индекс только по отзывам, ждущим решения
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_reviews_pending ON reviews(id) WHERE approved = FALSE AND rejected = FALSE"
+            )
+            
+            # Счетчики одобренных отзывов по оценкам; модерация корректирует их одним
+            # запросом на пакет. Правки отзывов в обход API (ручной SQL) счетчики не видят,
+            # поэтому они пересчитываются при каждом запуске и командой flask review-stats
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS review_stats (
+                    rating INTEGER PRIMARY KEY,
+                    count INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            # Построчные триггеры удвоили бы пакетную корректировку
+            for event in ('insert', 'update', 'delete'):
+                cursor.execute(f"DROP TRIGGER IF EXISTS review_stats_{event}")
+            self.rebuild_review_stats(cursor)
+        
+        conn.commit()
+        conn.close()
+    
+    def create_catalog_tables(self, cursor):
+        """Таблицы общего каталога: услуги, популярность, блог, галерея"""
         # Таблица услуг
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS services (
@@ -31,6 +603,74 @@ class Database:
             )
         ''')
         
+        # Таблица статей блога
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blog_posts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                excerpt TEXT NOT NULL,
+                content TEXT NOT NULL,
+                category TEXT NOT NULL,
+                author TEXT NOT NULL,
+                read_time TEXT NOT NULL,
+                image_url TEXT,
+                published BOOLEAN DEFAULT TRUE,
+                views INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица галереи
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS gallery (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                description TEXT,
+                category TEXT NOT NULL,
+                image_url TEXT,
+                featured BOOLEAN DEFAULT FALSE,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Рейтинг популярности услуг по истории записей
+        cursor.execute("PRAGMA table_info(services)")
+        if 'popularity_rank' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE services ADD COLUMN popularity_rank INTEGER")
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS service_popularity (
+                service_name TEXT PRIMARY KEY,
+                score REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # Покрывающий индекс для списка статей: краткая форма читается без content
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_blog_posts_list ON blog_posts
+            (published, created_at, category, id, title, excerpt, author, read_time, image_url, views)
+        ''')
+        
+        # Поколение каталога: меняется при любом изменении услуг
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS catalog_generation (
+                name TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO catalog_generation (name, generation) VALUES ('services', 0)")
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS services_generation_{event.lower()}
+                AFTER {event} ON services
+                BEGIN
+                    UPDATE catalog_generation SET generation = generation + 1 WHERE name = 'services';
+                END
+            ''')
+    
+    def create_branch_tables(self, cursor):
+        """Таблицы филиала: отзывы, записи, заказы, обращения и архив"""
         # Таблица отзывов
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS reviews (
@@ -46,6 +686,11 @@ class Database:
             )
         ''')
         
+        # Отклоненные при модерации отзывы не удаляются, а помечаются
+        cursor.execute("PRAGMA table_info(reviews)")
+        if 'rejected' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE reviews ADD COLUMN rejected BOOLEAN DEFAULT FALSE")
+        
         # Таблица записей на услуги
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS bookings (
@@ -78,37 +723,6 @@ class Database:
             )
         ''')
         
-        # Таблица статей блога
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blog_posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                excerpt TEXT NOT NULL,
-                content TEXT NOT NULL,
-                category TEXT NOT NULL,
-                author TEXT NOT NULL,
-                read_time TEXT NOT NULL,
-                image_url TEXT,
-                published BOOLEAN DEFAULT TRUE,
-                views INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица галереи
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS gallery (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT,
-                category TEXT NOT NULL,
-                image_url TEXT,
-                featured BOOLEAN DEFAULT FALSE,
-                active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
         # Таблица контактов
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS contacts (
@@ -122,11 +736,28 @@ class Database:
             )
         ''')
         
-        # Вставляем начальные данные
-        self.insert_initial_data(cursor)
-        
-        conn.commit()
-        conn.close()
+        # Архив: таблицы с той же схемой и граница архивации по каждой
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive.archive_state (
+                table_name TEXT PRIMARY KEY,
+                cutoff TEXT NOT NULL,
+                archived_rows INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for table in ARCHIVE_TABLES:
+            cursor.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            ddl = cursor.fetchone()[0]
+            cursor.execute(re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE IF NOT EXISTS archive.{table}', ddl))
+    
+    @staticmethod
+    def rebuild_review_stats(cursor):
+        """Полный пересчет review_stats по таблице отзывов"""
+        cursor.execute("DELETE FROM review_stats")
+        cursor.execute('''
+            INSERT INTO review_stats (rating, count)
+            SELECT rating, COUNT(*) FROM reviews WHERE approved = TRUE GROUP BY rating
+        ''')
     
     def insert_initial_data(self, cursor):
         """Вставка начальных данных в базу"""
@@ -154,22 +785,23 @@ class Database:
                 services
             )
         
-        # Начальные отзывы
-        cursor.execute("SELECT COUNT(*) FROM reviews")
-        if cursor.fetchone()[0] == 0:
-            reviews = [
-                ('Анна К.', 'АК', 5, 'Очень довольна услугами салона! Моего пуделя стригут просто идеально. Персонал внимательный и заботливый.', 'Стрижка и укладка', 'собака'),
-                ('Игорь П.', 'ИП', 5, 'Привожу своего кота уже больше года. Всегда отличный результат! Спасибо за профессионализм.', 'Комплексный груминг', 'кот'),
-                ('Марина С.', 'МС', 5, 'Лучший груминг-салон в городе! Цены адекватные, качество на высоте. Мой шпиц всегда выглядит ухоженным.', 'Комплексный груминг', 'собака'),
-                ('Дмитрий В.', 'ДВ', 4, 'Хороший салон, качественные услуги. Единственное, пришлось немного подождать в очереди.', 'Гигиенический уход', 'собака'),
-                ('Ольга М.', 'ОМ', 5, 'Впервые привела свою собаку на груминг и осталась очень довольна. Специалисты знают свое дело.', 'Комплексный груминг', 'собака')
-            ]
+        # Начальные отзывы (только в базе с таблицами филиала)
+        if self.branch:
+            cursor.execute("SELECT COUNT(*) FROM reviews")
+            if cursor.fetchone()[0] == 0:
+                reviews = [
+                    ('Анна К.', 'АК', 5, 'Очень довольна услугами салона! Моего пуделя стригут просто идеально. Персонал внимательный и заботливый.', 'Стрижка и укладка', 'собака'),
+                    ('Игорь П.', 'ИП', 5, 'Привожу своего кота уже больше года. Всегда отличный результат! Спасибо за профессионализм.', 'Комплексный груминг', 'кот'),
+                    ('Марина С.', 'МС', 5, 'Лучший груминг-салон в городе! Цены адекватные, качество на высоте. Мой шпиц всегда выглядит ухоженным.', 'Комплексный груминг', 'собака'),
+                    ('Дмитрий В.', 'ДВ', 4, 'Хороший салон, качественные услуги. Единственное, пришлось немного подождать в очереди.', 'Гигиенический уход', 'собака'),
+                    ('Ольга М.', 'ОМ', 5, 'Впервые привела свою собаку на груминг и осталась очень довольна. Специалисты знают свое дело.', 'Комплексный груминг', 'собака')
+                ]
+                
+                cursor.executemany(
+                    "INSERT INTO reviews (author_name, author_avatar, rating, review_text, service_name, pet_type, approved) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(r[0], r[1], r[2], r[3], r[4], r[5], True) for r in reviews]
+                )
             
-            cursor.executemany(
-                "INSERT INTO reviews (author_name, author_avatar, rating, review_text, service_name, pet_type, approved) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                [(r[0], r[1], r[2], r[3], r[4], r[5], True) for r in reviews]
-            )
-        
         # Начальные статьи блога
         cursor.execute("SELECT COUNT(*) FROM blog_posts")
         if cursor.fetchone()[0] == 0:
@@ -221,6 +853,599 @@ class Database:
                 gallery_items
             )
 
+# Шардирование по филиалам
+class ShardRouter:
+    """Маршрутизация по филиалам салона: у каждого филиала свой файл базы
+    и свой пул соединений, общий каталог (услуги, блог, галерея) хранится
+    в отдельной базе"""
+    
+    DEFAULT_BRANCH = 'main'
+    # Таблицы, которые при шардировании живут в базах филиалов
+    BRANCH_TABLES = ('reviews', 'bookings', 'orders', 'contacts')
+    
+    def __init__(self, catalog, branches=None, shard_path='grooming_salon_{branch}.db', default_branch=None):
+        self.catalog = catalog
+        
+        if branches:
+            self.shards = {
+                branch: Database(shard_path.format(branch=branch), profiler=catalog.profiler, seed=False, catalog=False)
+                for branch in branches
+            }
+        else:
+            # Один салон: каталог и записи живут в одной базе
+            self.shards = {self.DEFAULT_BRANCH: catalog}
+        
+        self.default_branch = default_branch or next(iter(self.shards))
+        if self.default_branch not in self.shards:
+            raise ValueError(f'Unknown default branch: {self.default_branch}')
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard')
+        
+        # Данные, накопленные до включения шардирования, достаются филиалу по умолчанию
+        if self.sharded:
+            self.migrate_legacy_rows()
+    
+    def migrate_legacy_rows(self, batch_size=500):
+        """Перенос отзывов, записей, заказов и обращений из общей базы в базу
+        филиала по умолчанию, а архивных строк общей базы - в архив филиала
+        вместе с границей архивации. Каждая транзакция пишет только в один файл:
+        строки копируются вместе с отметкой в branch_migration той же базы, затем
+        удаляются из источника по этим отметкам, поэтому повторный запуск после
+        сбоя ничего не теряет и не дублирует. Идентификаторы сохраняются, пока
+        филиал не выдавал в таблице собственных; иначе строки получают новые,
+        а архивные строки попадают в горячую таблицу до следующей архивации"""
+        target = self.get(self.default_branch)
+        conn = sqlite3.connect(target.db_path, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("ATTACH DATABASE ? AS archive", (target.archive_path,))
+        conn.execute("ATTACH DATABASE ? AS legacy", (self.catalog.db_path,))
+        conn.execute("ATTACH DATABASE ? AS legacy_archive", (self.catalog.archive_path,))
+        cursor = conn.cursor()
+        moved = {}
+        
+        def exists(schema, table):
+            cursor.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            return cursor.fetchone() is not None
+        
+        # Отметки обеих баз филиала: строка с таким id уже перенесена из общей базы
+        # или из ее архива (id у них из одной последовательности)
+        migrated = '''
+            SELECT source_id FROM main.branch_migration WHERE table_name = ?
+            UNION ALL SELECT source_id FROM archive.branch_migration WHERE table_name = ?
+        '''
+        
+        try:
+            for schema in ('main', 'archive'):
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {schema}.branch_migration (
+                        table_name TEXT NOT NULL,
+                        source_id INTEGER NOT NULL,
+                        row_id INTEGER NOT NULL,
+                        PRIMARY KEY (table_name, source_id)
+                    )
+                ''')
+            
+            # Граница архивации переносится раньше строк, чтобы чтение учитывало архив филиала
+            if exists('legacy_archive', 'archive_state'):
+                cursor.execute('''
+                    INSERT INTO archive.archive_state (table_name, cutoff, archived_rows)
+                    SELECT table_name, cutoff, archived_rows FROM legacy_archive.archive_state WHERE TRUE
+                    ON CONFLICT(table_name) DO UPDATE SET
+                        cutoff = MAX(cutoff, excluded.cutoff),
+                        updated_at = CURRENT_TIMESTAMP
+                ''')
+            
+            for table in self.BRANCH_TABLES:
+                moved[table] = 0
+                if not exists('legacy', table):
+                    continue
+                
+                cursor.execute(f"PRAGMA legacy.table_info({table})")
+                columns = [row[1] for row in cursor.fetchall() if row[1] != 'id']
+                
+                # id сохраняются, если все выданные филиалом id достались перенесенным строкам
+                cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM main.sqlite_sequence WHERE name = ?", (table,))
+                shard_seq = cursor.fetchone()[0]
+                cursor.execute('''
+                    SELECT MAX(COALESCE((SELECT MAX(row_id) FROM main.branch_migration WHERE table_name = ?1), 0),
+                               COALESCE((SELECT MAX(row_id) FROM archive.branch_migration WHERE table_name = ?1), 0))
+                ''', (table,))
+                keep_ids = shard_seq <= cursor.fetchone()[0]
+                insert_columns = ['id'] + columns if keep_ids else columns
+                
+                # Архивные строки идут в архив филиала; с новыми id - в горячую
+                # таблицу, потому что id выдает только ее последовательность
+                sources = [(f'legacy.{table}', 'main')]
+                if exists('legacy_archive', table):
+                    sources.append((f'legacy_archive.{table}', 'archive' if keep_ids else 'main'))
+                
+                # Копирование в базу филиала
+                for source, schema in sources:
+                    insert_sql = f'''
+                        INSERT INTO {schema}.{table} ({', '.join(insert_columns)})
+                        VALUES ({', '.join('?' for _ in insert_columns)})
+                    '''
+                    while True:
+                        cursor.execute("BEGIN IMMEDIATE")
+                        try:
+                            cursor.execute(f'''
+                                SELECT id, {', '.join(columns)} FROM {source}
+                                WHERE id NOT IN ({migrated})
+                                ORDER BY id LIMIT ?
+                            ''', (table, table, batch_size))
+                            rows = cursor.fetchall()
+                            for row in rows:
+                                cursor.execute(insert_sql, row if keep_ids else row[1:])
+                                cursor.execute(
+                                    f"INSERT INTO {schema}.branch_migration (table_name, source_id, row_id) VALUES (?, ?, ?)",
+                                    (table, row[0], cursor.lastrowid)
+                                )
+                            cursor.execute("COMMIT")
+                        except Exception:
+                            cursor.execute("ROLLBACK")
+                            raise
+                        
+                        moved[table] += len(rows)
+                        if len(rows) < batch_size:
+                            break
+                
+                # Новые строки филиала получают id после всех перенесенных, в том числе архивных
+                if keep_ids:
+                    cursor.execute("SELECT seq FROM legacy.sqlite_sequence WHERE name = ?", (table,))
+                    row = cursor.fetchone()
+                    if row is not None:
+                        cursor.execute("UPDATE main.sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (row[0], table))
+                        if cursor.rowcount == 0:
+                            cursor.execute("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (table, row[0]))
+                
+                # Удаление перенесенных строк из общей базы
+                for source, schema in sources:
+                    while True:
+                        cursor.execute("BEGIN IMMEDIATE")
+                        cursor.execute(f'''
+                            DELETE FROM {source} WHERE id IN (
+                                SELECT id FROM {source}
+                                WHERE id IN ({migrated})
+                                LIMIT ?
+                            )
+                        ''', (table, table, batch_size))
+                        deleted = cursor.rowcount
+                        cursor.execute("COMMIT")
+                        if deleted < batch_size:
+                            break
+        
+        finally:
+            conn.close()
+        
+        if moved['reviews']:
+            conn = target.get_connection()
+            Database.rebuild_review_stats(conn.cursor())
+            conn.commit()
+            conn.close()
+        
+        return moved
+    
+    @property
+    def sharded(self):
+        return any(shard is not self.catalog for shard in self.shards.values())
+    
+    def __contains__(self, branch):
+        return branch in self.shards
+    
+    def get(self, branch=None):
+        return self.shards[branch or self.default_branch]
+    
+    def fan_out(self, func):
+        """Параллельный вызов func(branch, database) на всех шардах, результат - {branch: value}"""
+        futures = {
+            branch: self._executor.submit(func, branch, shard)
+            for branch, shard in self.shards.items()
+        }
+        return {branch: future.result() for branch, future in futures.items()}
+
+# Идемпотентность POST-запросов
+class IdempotencyStore:
+    """Ключи идемпотентности: таблица idempotency_keys с LRU-кэшем в памяти.
+    Повтор запроса с тем же ключом получает сохраненный ответ"""
+    
+    NEW, REPLAY, CONFLICT, IN_PROGRESS = 'new', 'replay', 'conflict', 'in_progress'
+    
+    def __init__(self, database, ttl=24 * 3600, cache_size=1024):
+        self.database = database
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._evictor = None
+        self.init_table()
+    
+    def init_table(self):
+        conn = self.database.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                request_hash TEXT NOT NULL,
+                status_code INTEGER,
+                response_body TEXT,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys(expires_at)")
+        
+        conn.commit()
+        conn.close()
+    
+    def _cache_get(self, key):
+        with self._lock:
+            record = self._cache.get(key)
+            if record is None:
+                return None
+            if record['expires_at'] < time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return record
+    
+    def _cache_put(self, key, record):
+        with self._lock:
+            self._cache[key] = record
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _resolve(self, record, request_hash):
+        if record['request_hash'] != request_hash:
+            return self.CONFLICT, record
+        if record['status_code'] is None:
+            return self.IN_PROGRESS, record
+        return self.REPLAY, record
+    
+    def begin(self, key, request_hash):
+        """Резервирует ключ; возвращает (состояние, запись)"""
+        record = self._cache_get(key)
+        if record is not None:
+            return self._resolve(record, request_hash)
+        
+        now = time.time()
+        conn = self.database.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT OR IGNORE INTO idempotency_keys (key, request_hash, expires_at)
+                VALUES (?, ?, ?)
+            ''', (key, request_hash, now + self.ttl))
+            
+            if cursor.rowcount == 0:
+                # Ключ уже есть: просроченный занимаем заново, иначе отдаем сохраненное
+                cursor.execute('''
+                    UPDATE idempotency_keys
+                    SET request_hash = ?, status_code = NULL, response_body = NULL, expires_at = ?
+                    WHERE key = ? AND expires_at < ?
+                ''', (request_hash, now + self.ttl, key, now))
+                
+                if cursor.rowcount == 0:
+                    cursor.execute('''
+                        SELECT request_hash, status_code, response_body, expires_at
+                        FROM idempotency_keys WHERE key = ?
+                    ''', (key,))
+                    row = cursor.fetchone()
+                    record = {
+                        'request_hash': row[0],
+                        'status_code': row[1],
+                        'response_body': row[2],
+                        'expires_at': row[3]
+                    }
+                    if record['status_code'] is not None:
+                        self._cache_put(key, record)
+                    return self._resolve(record, request_hash)
+            
+            conn.commit()
+            return self.NEW, None
+        finally:
+            conn.close()
+    
+    def complete(self, key, request_hash, status_code, response_body):
+        expires_at = time.time() + self.ttl
+        conn = self.database.get_connection()
+        conn.execute('''
+            UPDATE idempotency_keys
+            SET status_code = ?, response_body = ?, expires_at = ?
+            WHERE key = ? AND request_hash = ?
+        ''', (status_code, response_body, expires_at, key, request_hash))
+        conn.commit()
+        conn.close()
+        
+        self._cache_put(key, {
+            'request_hash': request_hash,
+            'status_code': status_code,
+            'response_body': response_body,
+            'expires_at': expires_at
+        })
+    
+    def release(self, key, request_hash):
+        """Снимает резерв, если запрос не удался и его можно повторить"""
+        conn = self.database.get_connection()
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND request_hash = ? AND status_code IS NULL",
+            (key, request_hash)
+        )
+        conn.commit()
+        conn.close()
+    
+    def evict_expired(self, batch_size=500):
+        """Удаление просроченных ключей пачками, чтобы не держать блокировку записи"""
+        now = time.time()
+        deleted = 0
+        while True:
+            conn = self.database.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM idempotency_keys WHERE rowid IN (
+                    SELECT rowid FROM idempotency_keys WHERE expires_at < ? LIMIT ?
+                )
+            ''', (now, batch_size))
+            count = cursor.rowcount
+            conn.commit()
+            conn.close()
+            
+            deleted += count
+            if count < batch_size:
+                break
+        
+        with self._lock:
+            for key in [k for k, record in self._cache.items() if record['expires_at'] < now]:
+                del self._cache[key]
+        return deleted
+    
+    def start_evictor(self, interval=300):
+        """Фоновая очистка просроченных ключей"""
+        if self._evictor is not None:
+            return
+        
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.evict_expired()
+                except sqlite3.Error:
+                    pass
+        
+        self._evictor = threading.Thread(target=loop, name='idempotency-evictor', daemon=True)
+        self._evictor.start()
+
+# Популярность услуг
+class PopularityEngine:
+    """Инкрементальные счетчики записей по услугам с экспоненциальным затуханием.
+    Счет хранится приведенным к фиксированной эпохе: вклад записи в момент t равен
+    2^((t - EPOCH) / half_life), поэтому обновление - это одно сложение, а порядок
+    по сохраненному счету совпадает с порядком по текущему затухшему счету.
+    Приращения копятся в памяти процесса и записываются в общую базу только
+    периодической сверткой, которая заодно переносит рейтинг в services
+    (popular, popularity_rank): записи филиалов не ждут блокировку записи каталога"""
+    
+    EPOCH = datetime(2024, 1, 1).timestamp()
+    # Минимальный затухший счет (в записях), ниже которого услуга не считается популярной
+    MIN_SCORE = 0.01
+    
+    def __init__(self, database, half_life_days=30, top_n=3, min_history=20):
+        self.database = database
+        self.half_life = half_life_days * 24 * 3600
+        self.top_n = top_n
+        # Сколько (затухших) записей нужно, чтобы рейтинг заменил флаги, заданные вручную
+        self.min_history = min_history
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def weight(self, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        return 2 ** ((timestamp - self.EPOCH) / self.half_life)
+    
+    def record(self, service_name, delta=1, timestamp=None):
+        """Учет записи (delta=1) или ее отмены (delta=-1, timestamp - время создания записи).
+        Только в памяти; в базу попадает при следующей свертке"""
+        weight = delta * self.weight(timestamp)
+        with self._lock:
+            self._pending[service_name] = self._pending.get(service_name, 0) + weight
+    
+    def scores(self):
+        """Текущие (затухшие) счета по названиям услуг"""
+        decay = self.weight()
+        conn = self.database.get_connection()
+        rows = conn.execute("SELECT service_name, score FROM service_popularity").fetchall()
+        conn.close()
+        return {name: score / decay for name, score in rows}
+    
+    def fold(self):
+        """Запись накопленных приращений и пересчет рейтинга в services; меняются
+        только строки с новым значением, поэтому каталог перечитывается лишь
+        при реальном изменении рейтинга"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        
+        conn = self.database.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.executemany('''
+                INSERT INTO service_popularity (service_name, score) VALUES (?, MAX(0, ?2))
+                ON CONFLICT(service_name) DO UPDATE SET score = MAX(0, score + excluded.score)
+            ''', pending.items())
+            
+            cursor.execute('''
+                SELECT s.id, COALESCE(p.score, 0) AS score
+                FROM services s LEFT JOIN service_popularity p ON p.service_name = s.name
+                WHERE s.active = TRUE
+                ORDER BY score DESC, s.name ASC
+            ''')
+            decay = self.weight()
+            rows = [(service_id, score / decay) for service_id, score in cursor.fetchall()]
+            
+            # Пока истории записей мало, остаются флаги, заданные вручную
+            changed = 0
+            if sum(score for _, score in rows) >= self.min_history:
+                ranking = [
+                    (rank, rank <= self.top_n and score >= self.MIN_SCORE, service_id)
+                    for rank, (service_id, score) in enumerate(rows, start=1)
+                ]
+                cursor.executemany('''
+                    UPDATE services SET popularity_rank = ?, popular = ?
+                    WHERE id = ? AND (popularity_rank IS NOT ?1 OR popular IS NOT ?2)
+                ''', ranking)
+                changed = cursor.rowcount
+            conn.commit()
+        except Exception:
+            # Приращения вернутся к следующей свертке
+            with self._lock:
+                for name, weight in pending.items():
+                    self._pending[name] = self._pending.get(name, 0) + weight
+            raise
+        finally:
+            conn.close()
+        
+        return changed
+    
+    def rebuild(self, shards):
+        """Пересчет счетчиков с нуля по истории записей всех филиалов"""
+        # Накопленные приращения уже учтены в истории
+        with self._lock:
+            self._pending.clear()
+        
+        totals = {}
+        for shard in shards:
+            conn = shard.get_connection()
+            rows = conn.execute('''
+                SELECT service_name, CAST(strftime('%s', created_at) AS REAL)
+                FROM bookings WHERE status != 'cancelled'
+            ''').fetchall()
+            conn.close()
+            for service_name, created in rows:
+                totals[service_name] = totals.get(service_name, 0) + self.weight(created)
+        
+        conn = self.database.get_connection()
+        # Названия в записях приходят от клиентов: счет ведется только по услугам каталога
+        names = {row[0] for row in conn.execute("SELECT name FROM services")}
+        totals = {name: score for name, score in totals.items() if name in names}
+        conn.execute("DELETE FROM service_popularity")
+        conn.executemany("INSERT INTO service_popularity (service_name, score) VALUES (?, ?)", totals.items())
+        conn.commit()
+        conn.close()
+        return len(totals)
+    
+    def start(self, interval=300):
+        """Периодическая свертка рейтинга в фоне"""
+        if self._thread is not None:
+            return
+        
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.fold()
+                except sqlite3.Error:
+                    pass
+        
+        self._thread = threading.Thread(target=loop, name='popularity-fold', daemon=True)
+        self._thread.start()
+
+# Каталог услуг в памяти процесса
+class _CatalogSnapshot:
+    """Неизменяемый снимок каталога с готовыми JSON-ответами"""
+    
+    SORTS = ('default', 'popular')
+    
+    def __init__(self, services, ranks, generation, dumps):
+        self.generation = generation
+        self.services = tuple(MappingProxyType(service) for service in services)
+        self.by_id = MappingProxyType({service['id']: service for service in self.services})
+        self.by_name = MappingProxyType({service['name']: service for service in self.services})
+        # Место в рейтинге популярности (по истории записей), None - нет данных
+        self.ranks = MappingProxyType(dict(ranks))
+        
+        by_category = {}
+        for service in self.services:
+            by_category.setdefault(service['category'], []).append(service)
+        self.by_category = MappingProxyType({c: tuple(items) for c, items in by_category.items()})
+        self.popular = tuple(service for service in self.services if service['popular'])
+        
+        # Тела ответов для всех комбинаций фильтров и для каждой услуги
+        bodies = {}
+        for category in [None, *self.by_category]:
+            for popular in (False, True):
+                items = self.services if category is None else self.by_category[category]
+                if popular:
+                    items = [service for service in items if service['popular']]
+                bodies[(category, popular, 'default')] = dumps({'success': True, 'data': [dict(s) for s in items]})
+                
+                items = sorted(items, key=self._rank_key)
+                bodies[(category, popular, 'popular')] = dumps({'success': True, 'data': [dict(s) for s in items]})
+        self._list_bodies = MappingProxyType(bodies)
+        self._empty_body = dumps({'success': True, 'data': []})
+        self._item_bodies = MappingProxyType({
+            service_id: dumps({'success': True, 'data': dict(service)})
+            for service_id, service in self.by_id.items()
+        })
+    
+    def _rank_key(self, service):
+        # Без рейтинга - тот же порядок, что и по умолчанию (popular DESC, name ASC)
+        rank = self.ranks.get(service['id'])
+        return (rank is None, rank or 0, not service['popular'], service['name'])
+    
+    def list_body(self, category=None, popular=False, sort='default'):
+        return self._list_bodies.get((category, popular, sort), self._empty_body)
+    
+    def item_body(self, service_id):
+        return self._item_bodies.get(service_id)
+
+class ServiceCatalog:
+    """Каталог активных услуг, загружаемый в память один раз.
+    Перечитывается атомарно, когда PRAGMA data_version выделенного соединения
+    и счетчик catalog_generation показывают изменение таблицы services,
+    в том числе сделанное другими процессами"""
+    
+    def __init__(self, database, dumps=None):
+        self.database = database
+        self.dumps = dumps or (lambda obj: json.dumps(obj, sort_keys=True, separators=(',', ':')))
+        self._conn = sqlite3.connect(database.db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._snapshot = None
+    
+    def snapshot(self):
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self._data_version or self._snapshot is None:
+                generation = self._conn.execute(
+                    "SELECT generation FROM catalog_generation WHERE name = 'services'"
+                ).fetchone()[0]
+                if self._snapshot is None or generation != self._snapshot.generation:
+                    self._snapshot = self._load()
+                self._data_version = data_version
+            return self._snapshot
+    
+    def _load(self):
+        # Поколение и строки читаются в одной транзакции
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT generation FROM catalog_generation WHERE name = 'services'")
+            generation = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT id, name, description, price, category, duration, popular, popularity_rank
+                FROM services WHERE active = TRUE
+                ORDER BY popular DESC, name ASC
+            ''')
+            rows = cursor.fetchall()
+        finally:
+            cursor.execute("COMMIT")
+        
+        services = [Service(*row[:7]).to_dict() for row in rows]
+        ranks = {row[0]: row[7] for row in rows if row[7] is not None}
+        return _CatalogSnapshot(services, ranks, generation, self.dumps)
+    
+    def close(self):
+        self._conn.close()
+
 # Модели данных
 class Service:
     def __init__(self, id, name, description, price, category, duration=60, popular=False):
@@ -0,0 +1,163 @@
+import itertools
+import json
+import threading
+from collections import deque
+
+class Subscription:
+    """Подписка одного клиента с ограниченным буфером событий"""
+
+    def __init__(self, broker, last_event_id, buffer_size, types=None):
+        self.broker = broker
+        self.last_event_id = last_event_id
+        self.types = tuple(types) if types else None
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.overflowed = False
+        self.replay_until = 0
+
+    def wants(self, event_type):
+        return self.types is None or event_type.startswith(self.types)
+
+    def push(self, event):
+        # Вызывается под блокировкой брокера
+        if len(self.buffer) >= self.buffer_size:
+            # Клиент не успевает: буфер сбрасывается, пропущенное дочитается из журнала
+            self.overflowed = True
+            self.buffer.clear()
+        else:
+            self.buffer.append(event)
+
+    def events(self, timeout=15):
+        """Генератор событий; None означает, что за timeout ничего не пришло"""
+        broker = self.broker
+        while True:
+            if self.last_event_id < self.replay_until:
+                # Догоняем по журналу событий
+                for event in broker.read_log(self.last_event_id, self.replay_until):
+                    if self.wants(event['type']):
+                        yield event
+                self.last_event_id = self.replay_until
+
+            with broker.condition:
+                if not self.buffer and not self.overflowed:
+                    broker.condition.wait(timeout)
+
+                if self.overflowed:
+                    # Все, что успело попасть в буфер после сброса, тоже будет в журнале
+                    self.overflowed = False
+                    self.buffer.clear()
+                    self.replay_until = broker.last_id
+                    continue
+
+                # Параллельные публикации могут попасть в буфер не в порядке id;
+                # события до replay_until уже отданы из журнала
+                pending = sorted(
+                    (event for event in self.buffer if event['id'] > self.replay_until),
+                    key=lambda event: event['id']
+                )
+                self.buffer.clear()
+
+            if not pending:
+                yield None
+                continue
+
+            for event in pending:
+                self.last_event_id = max(self.last_event_id, event['id'])
+                yield event
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class EventBroker:
+    """Внутрипроцессный pub/sub для SSE с журналом событий в таблице events.
+    Журнал нужен для возобновления по Last-Event-ID и хранит последние log_size событий"""
+
+    COMPACT_EVERY = 100
+
+    def __init__(self, database, buffer_size=256, log_size=10000):
+        self.database = database
+        self.buffer_size = buffer_size
+        self.log_size = log_size
+        self.condition = threading.Condition()
+        self._subscribers = set()
+        self._published = itertools.count(1)
+        self.init_log()
+
+    def init_log(self):
+        conn = self.database.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type TEXT NOT NULL,
+                branch TEXT,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM events")
+        self.last_id = cursor.fetchone()[0]
+
+        conn.commit()
+        conn.close()
+
+    def publish(self, event_type, data, branch=None):
+        payload = json.dumps(data, ensure_ascii=False)
+
+        # Запись в журнал - вне блокировки брокера, чтобы публикации не ждали друг друга
+        conn = self.database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO events (event_type, branch, payload) VALUES (?, ?, ?)",
+            (event_type, branch, payload)
+        )
+        event_id = cursor.lastrowid
+
+        if next(self._published) % self.COMPACT_EVERY == 0:
+            cursor.execute("DELETE FROM events WHERE id <= ?", (event_id - self.log_size,))
+
+        conn.commit()
+        conn.close()
+
+        # Под блокировкой только раздача подписчикам
+        event = {'id': event_id, 'type': event_type, 'branch': branch, 'data': payload}
+        with self.condition:
+            self.last_id = max(self.last_id, event_id)
+            for subscription in self._subscribers:
+                if subscription.wants(event_type):
+                    subscription.push(event)
+            self.condition.notify_all()
+
+        return event_id
+
+    def subscribe(self, last_event_id=None, types=None):
+        subscription = Subscription(self, last_event_id, self.buffer_size, types)
+        with self.condition:
+            subscription.replay_until = self.last_id
+            if subscription.last_event_id is None:
+                subscription.last_event_id = self.last_id
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self._subscribers.discard(subscription)
+
+    def read_log(self, after_id, until_id):
+        conn = self.database.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, event_type, branch, payload FROM events
+            WHERE id > ? AND id <= ?
+            ORDER BY id
+        ''', (after_id, until_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return [{'id': row[0], 'type': row[1], 'branch': row[2], 'data': row[3]} for row in rows]
+
+    @staticmethod
+    def format_sse(event):
+        if event is None:
+            return ': keepalive\n\n'
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {event['data']}\n\n"